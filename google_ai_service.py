@@ -1,123 +1,414 @@
 # google_ai_service.py
 
 import os
-import json
+import asyncio
 import logging
-import google.generativeai as genai
-from prompts import ANALYSIS_PROMPT
+import orjson
+import httpx
+from prompts import (
+    ANALYSIS_PROMPT,
+    ANALYSIS_SCHEMA,
+    BATCH_ANALYSIS_SCHEMA,
+    BATCH_INSTRUCTIONS,
+    MERGE_INSTRUCTIONS,
+    PARTIAL_SUMMARY_PROMPT,
+    PROMPT_BY_EXT,
+)
 
 # Load Google AI credentials
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_MODEL = os.getenv("GOOGLE_MODEL", "gemini-2.5-pro")
 MAX_RETRIES = 3
+GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GOOGLE_MODEL}:generateContent"
+GEMINI_STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GOOGLE_MODEL}:streamGenerateContent?alt=sse"
 
-# Configure Google AI
+# Static parts of the prompts, built once at import for every analysis prompt
+_PARTIAL_PROMPT_PREFIX = PARTIAL_SUMMARY_PROMPT + "\n\nDocument section:\n"
+_ANALYSIS_PREFIXES = {}
+_MERGE_PREFIXES = {}
+_BATCH_PREFIXES = {}
+for _prompt in {ANALYSIS_PROMPT, *PROMPT_BY_EXT.values()}:
+    _ANALYSIS_PREFIXES[_prompt] = _prompt + "\n\nDocument text to analyze:\n"
+    _MERGE_PREFIXES[_prompt] = _prompt + MERGE_INSTRUCTIONS + "\n\nSection summaries:\n"
+    _BATCH_PREFIXES[_prompt] = _prompt + BATCH_INSTRUCTIONS
+
+# Documents longer than this (~10k tokens) are summarized section by section
+# in parallel, then analyzed from the combined section summaries.
+LARGE_DOCUMENT_THRESHOLD = 40_000
+CHUNK_MIN_CHARS = 20_000
+MAX_CHUNKS = 8
+
+# Constrain analysis responses to JSON matching the prompt's format
+ANALYSIS_CONFIG = {"responseMimeType": "application/json", "responseSchema": ANALYSIS_SCHEMA}
+BATCH_ANALYSIS_CONFIG = {"responseMimeType": "application/json", "responseSchema": BATCH_ANALYSIS_SCHEMA}
+
+# Opt-in: concurrent requests are coalesced into a single Gemini call of up to
+# BATCH_MAX_SIZE documents, collected for at most BATCH_WINDOW_SECONDS.
+# Batched documents from different callers share one prompt, so one upload
+# can influence another's result; only enable this for trusted uploaders.
+BATCH_MAX_SIZE = int(os.getenv("GOOGLE_BATCH_MAX_SIZE", "1"))
+# Wait before falling back to per-document calls after a rate-limited batch
+BATCH_RATE_LIMIT_BACKOFF_SECONDS = 4
+BATCH_WINDOW_SECONDS = 0.05
+# Only documents up to LARGE_DOCUMENT_THRESHOLD characters are batched, so a
+# batch holds at most BATCH_MAX_SIZE * LARGE_DOCUMENT_THRESHOLD characters
+# (~80k tokens at the default 8), well inside the context window.
+
+# One queue and coalescing task per analysis prompt
+_batch_queues = {}
+_batch_workers = {}
+_batch_tasks = set()
+
+# Non-streaming calls receive nothing until generation finishes, so their
+# read timeout must cover a full long generation rather than one chunk
+NON_STREAMING_TIMEOUT = httpx.Timeout(300, connect=10)
+
+# Configure Google AI: one shared HTTP/2 client per worker so connections
+# and TLS sessions are reused across requests
 if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel(GOOGLE_MODEL)
+    _client = httpx.AsyncClient(
+        http2=True,
+        headers={"x-goog-api-key": GOOGLE_API_KEY},
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(120, connect=10),
+    )
 else:
-    model = None
+    _client = None
     logging.warning("Google API key not found. Set GOOGLE_API_KEY environment variable.")
 
-async def analyze_document(text: str) -> dict:
+async def aclose():
     """
-    Analyzes the document using Google's Generative AI with retries.
-    This single call handles classification and data extraction.
+    Stops the batching tasks and closes the shared HTTP client.
+    Called on application shutdown.
     """
-    logging.info("Starting unified document analysis with Google AI...")
-    
-    if not model:
+    tasks = [*_batch_workers.values(), *_batch_tasks]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _batch_workers.clear()
+    _batch_queues.clear()
+    if _client is not None:
+        await _client.aclose()
+
+async def _generate_content(prompt: str, generation_config: dict = None) -> str:
+    """
+    Calls the Gemini generateContent REST endpoint and returns the text of
+    the first candidate. Raises httpx.HTTPStatusError on API errors.
+    """
+    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    response = await _client.post(
+        GEMINI_URL,
+        content=orjson.dumps(payload),
+        headers={"content-type": "application/json"},
+        timeout=NON_STREAMING_TIMEOUT,
+    )
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    candidates = data.get("candidates") or []
+    if not candidates:
+        raise ValueError(f"No candidates in Google AI response: {data.get('promptFeedback')}")
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+async def _stream_generate_json(prompt: str, generation_config: dict) -> tuple:
+    """
+    Streams a JSON response from Gemini and returns (text, parsed object) as
+    soon as the accumulated output parses, without waiting for the stream to
+    close. The parsed object is None if the output never forms valid JSON.
+    Raises httpx.HTTPStatusError on API errors.
+    """
+    payload = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": generation_config}
+    parts = []
+    async with _client.stream(
+        "POST",
+        GEMINI_STREAM_URL,
+        content=orjson.dumps(payload),
+        headers={"content-type": "application/json"},
+    ) as response:
+        if response.is_error:
+            await response.aread()
+            response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            candidates = orjson.loads(line[5:]).get("candidates") or []
+            if not candidates:
+                continue
+            for part in candidates[0].get("content", {}).get("parts", []):
+                parts.append(part.get("text", ""))
+            # Only a closing brace can complete the object, so skip the parse
+            # attempt unless the text so far ends in one. Empty or
+            # whitespace-only parts may follow it, so check the last non-blank part.
+            tail = next((part for part in reversed(parts) if part.strip()), "")
+            if tail.rstrip().endswith("}"):
+                content = "".join(parts)
+                try:
+                    return content, orjson.loads(content)
+                except orjson.JSONDecodeError:
+                    continue
+
+    # The stream ended without an early parse; try the complete output once
+    content = "".join(parts)
+    try:
+        return content, orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return content, None
+
+async def analyze_document(text: str, kind: str = None) -> dict:
+    """
+    Analyzes the document using Google's Generative AI.
+    kind is the source file extension (e.g. ".csv") and selects a shorter,
+    specialized prompt where one exists.
+    Concurrent calls are coalesced into one batched request where possible.
+    """
+    if _client is None:
         logging.error("Google AI model not configured. Please set GOOGLE_API_KEY.")
         return _get_fallback_response("Google AI not configured")
-    
-    # Use full text for analysis, but consider truncating for very large docs if needed
-    content_to_send = text
+
+    prompt = PROMPT_BY_EXT.get(kind, ANALYSIS_PROMPT)
+
+    if len(text) > LARGE_DOCUMENT_THRESHOLD:
+        return await _analyze_large(text, prompt)
+
+    if BATCH_MAX_SIZE <= 1:
+        return await _analyze_single(text, _ANALYSIS_PREFIXES[prompt])
+
+    future = asyncio.get_running_loop().create_future()
+    await _get_batch_queue(prompt).put((text, future))
+    return await future
+
+def _get_batch_queue(prompt: str) -> asyncio.Queue:
+    """Lazily starts the background task that coalesces requests for a prompt."""
+    worker = _batch_workers.get(prompt)
+    if worker is None or worker.done():
+        _batch_queues[prompt] = asyncio.Queue()
+        _batch_workers[prompt] = asyncio.create_task(_batch_loop(_batch_queues[prompt], prompt))
+    return _batch_queues[prompt]
+
+async def _batch_loop(queue: asyncio.Queue, prompt: str):
+    """
+    Drains the queue into batches bounded by size and time, and dispatches
+    each batch without waiting for the previous one.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+
+        while len(batch) < BATCH_MAX_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        task = asyncio.create_task(_run_batch(batch, prompt))
+        _batch_tasks.add(task)
+        task.add_done_callback(_batch_tasks.discard)
+
+async def _run_batch(batch, prompt: str):
+    """Analyzes a batch and resolves each caller's future with its result."""
+    try:
+        if len(batch) == 1:
+            results = [await _analyze_single(batch[0][0], _ANALYSIS_PREFIXES[prompt])]
+        else:
+            results = await _analyze_batch([text for text, _ in batch], prompt)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+async def _analyze_batch(texts: list, prompt: str) -> list:
+    """
+    Analyzes several documents in one Gemini call. Falls back to analyzing
+    each document on its own if the batched response cannot be used.
+    """
+    logging.info(f"Sending batched analysis request for {len(texts)} documents to Google AI...")
+    parts = [_BATCH_PREFIXES[prompt]]
+    for index, text in enumerate(texts, start=1):
+        parts.append(f"\n\n=== Document {index} ===\n")
+        parts.append(text)
+
+    results = None
+    try:
+        results = orjson.loads(await _generate_content("".join(parts), BATCH_ANALYSIS_CONFIG))
+    except httpx.HTTPStatusError as e:
+        logging.warning(f"Batched analysis failed: {e}")
+        if e.response.status_code == 429:
+            # Don't answer a rate limit with an immediate burst of single calls
+            logging.warning("Batched analysis was rate limited. Backing off before analyzing individually.")
+            await asyncio.sleep(BATCH_RATE_LIMIT_BACKOFF_SECONDS)
+    except Exception as e:
+        logging.warning(f"Batched analysis failed: {e}")
+
+    if (
+        not isinstance(results, list)
+        or len(results) != len(texts)
+        or not all(isinstance(result, dict) for result in results)
+    ):
+        logging.warning("Unusable batched response. Analyzing documents individually.")
+        return await asyncio.gather(*(_analyze_single(text, _ANALYSIS_PREFIXES[prompt]) for text in texts))
+
+    logging.info(f"Successfully analyzed {len(texts)} documents in one Google AI call.")
+    return [_ensure_required_fields(result) for result in results]
+
+async def _analyze_large(text: str, prompt: str) -> dict:
+    """
+    Map-reduce analysis for long documents: sections are summarized
+    concurrently, then one final call analyzes the combined summaries.
+    A section that cannot be summarized is passed to the final call as-is.
+    """
+    chunks = _split_into_chunks(text, max(CHUNK_MIN_CHARS, -(-len(text) // MAX_CHUNKS)), MAX_CHUNKS)
+    logging.info(f"Document has {len(text)} characters; summarizing {len(chunks)} sections in parallel...")
+
+    partials = await asyncio.gather(*(_summarize_chunk(chunk) for chunk in chunks))
+    failed = partials.count("")
+    if failed:
+        logging.warning(f"{failed} of {len(chunks)} sections could not be summarized; sending their text unsummarized.")
+
+    sections = [
+        f"=== Section {index} ===\n{partial or chunk}"
+        for index, (chunk, partial) in enumerate(zip(chunks, partials), start=1)
+    ]
+    return await _analyze_single("\n\n".join(sections), _MERGE_PREFIXES[prompt])
+
+def _split_into_chunks(text: str, chunk_size: int, max_chunks: int) -> list:
+    """
+    Splits text into at most max_chunks chunks of roughly chunk_size
+    characters on paragraph boundaries. Paragraphs longer than chunk_size
+    are split by length.
+    """
+    chunks = []
+    current = []
+    current_len = 0
+    for paragraph in text.split("\n\n"):
+        pieces = [paragraph[i:i + chunk_size] for i in range(0, len(paragraph), chunk_size)] or [""]
+        for piece in pieces:
+            if current and current_len + len(piece) > chunk_size:
+                chunks.append("\n\n".join(current))
+                current = []
+                current_len = 0
+            current.append(piece)
+            current_len += len(piece) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+
+    # Greedy packing can overshoot the count when paragraphs are just over
+    # half of chunk_size; merge the smallest adjacent pair until it fits
+    while len(chunks) > max_chunks:
+        i = min(range(len(chunks) - 1), key=lambda j: len(chunks[j]) + len(chunks[j + 1]))
+        chunks[i:i + 2] = [chunks[i] + "\n\n" + chunks[i + 1]]
+    return chunks
+
+async def _summarize_chunk(chunk: str) -> str:
+    """
+    Summarizes one section of a long document with retries.
+    Returns an empty string if every attempt fails.
+    """
+    prompt = _PARTIAL_PROMPT_PREFIX + chunk
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            summary = (await _generate_content(prompt)).strip()
+            if summary:
+                return summary
+            logging.warning(f"Attempt {attempt}: Empty section summary from Google AI")
+        except httpx.HTTPStatusError as e:
+            logging.warning(f"Attempt {attempt} to summarize a section failed: {e}")
+            if attempt < MAX_RETRIES:
+                # Back off harder when rate limited, as in _analyze_single
+                await asyncio.sleep(2 ** attempt if e.response.status_code == 429 else 2 ** (attempt - 1))
+        except Exception as e:
+            logging.warning(f"Attempt {attempt} to summarize a section failed: {e}")
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(2 ** (attempt - 1))
+    return ""
+
+async def _analyze_single(text: str, prompt_prefix: str) -> dict:
+    """
+    Analyzes one document using Google's Generative AI with retries.
+    This single call handles classification and data extraction.
+    """
+    logging.info("Starting unified document analysis with Google AI...")
+
+    # Build the prompt once; every retry sends the same string
+    prompt = prompt_prefix + text
 
     for attempt in range(1, MAX_RETRIES + 1):
         try:
             logging.info(f"Attempt {attempt}: Sending analysis request to Google AI...")
             
-            # Create the prompt for Google AI
-            prompt = f"{ANALYSIS_PROMPT}\n\nDocument text to analyze:\n{content_to_send}"
-            
-            response = model.generate_content(prompt)
+            # Parsed while streaming; the response schema guarantees bare JSON
+            content, result = await _stream_generate_json(prompt, ANALYSIS_CONFIG)
             
-            if response.text:
-                content = response.text.strip()
-                # Try to extract JSON from the response
-                try:
-                    # Look for JSON in the response
-                    start_idx = content.find('{')
-                    end_idx = content.rfind('}') + 1
-                    if start_idx != -1 and end_idx != 0:
-                        json_content = content[start_idx:end_idx]
-                        result = json.loads(json_content)
-                    else:
-                        # If no JSON found, try to parse the entire response
-                        result = json.loads(content)
-                    
-                    if isinstance(result, dict):
-                        # Ensure we have the required fields
-                        if 'document_type' not in result:
-                            result['document_type'] = 'Document'
-                        if 'summary' not in result:
-                            result['summary'] = 'Document analyzed successfully'
-                        if 'key_information' not in result:
-                            result['key_information'] = {}
-                        if 'extracted_data' not in result:
-                            result['extracted_data'] = {}
-                        
-                        logging.info("Successfully analyzed document with Google AI.")
-                        return result
-                    else:
-                        logging.warning(f"Attempt {attempt}: Unexpected analysis JSON format. Result: {result}")
-                        # Continue to retry if format is wrong
-                        
-                except json.JSONDecodeError as e:
-                    logging.warning(f"Attempt {attempt} failed with JSON decode error: {e}. Response: {content}")
-                    # Try to create a structured response from the text
-                    if attempt == MAX_RETRIES:
-                        return _create_structured_response_from_text(content)
-            else:
+            if not content:
                 logging.warning(f"Attempt {attempt}: Empty response from Google AI")
+            elif result is None:
+                # Only truncated output (e.g. hitting the token limit) ends up here
+                logging.warning(f"Attempt {attempt}: Response was not valid JSON. Response: {content}")
+            elif isinstance(result, dict):
+                logging.info("Successfully analyzed document with Google AI.")
+                return _ensure_required_fields(result)
+            else:
+                logging.warning(f"Attempt {attempt}: Unexpected analysis JSON format. Result: {result}")
+                # Continue to retry if format is wrong
 
-        except Exception as e:
-            logging.warning(f"Attempt {attempt} failed with API error: {e}")
-            
+        except httpx.HTTPStatusError as e:
             # Handle rate limiting specifically
-            if "429" in str(e) or "quota" in str(e).lower():
-                logging.warning("Rate limit exceeded. Consider waiting or upgrading your plan.")
+            if e.response.status_code == 429:
+                logging.warning(f"Attempt {attempt}: Rate limit exceeded. Consider waiting or upgrading your plan.")
                 if attempt == MAX_RETRIES:
                     return _get_fallback_response("Rate limit exceeded. Please try again later or upgrade your Google AI plan.")
-            
+                # Back off harder when rate limited
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            logging.warning(f"Attempt {attempt} failed with API error: {e}")
+            if attempt == MAX_RETRIES:
+                logging.error("All analysis attempts failed.")
+                return _get_fallback_response(f"Analysis completed with limited information after {MAX_RETRIES} retries: {e}")
+            await asyncio.sleep(2 ** (attempt - 1))
+
+        except Exception as e:
+            logging.warning(f"Attempt {attempt} failed with API error: {e}")
             if attempt == MAX_RETRIES:
                 logging.error("All analysis attempts failed.")
-                return _get_fallback_response(f"Analysis completed with limited information after {MAX_RETRIES} retries: {str(e)}")
+                return _get_fallback_response(f"Analysis completed with limited information after {MAX_RETRIES} retries: {e}")
+
+            # Exponential backoff before the next attempt
+            await asyncio.sleep(2 ** (attempt - 1))
 
     # Fallback response if all retries fail to produce a valid dict
     logging.error("All analysis attempts failed to produce a valid result.")
     return _get_fallback_response("Analysis completed with fallback method")
 
-def _create_structured_response_from_text(text: str) -> dict:
+def _ensure_required_fields(result: dict) -> dict:
     """
-    Creates a structured response from plain text when JSON parsing fails.
+    Fills in any required fields missing from a parsed analysis.
     """
-    return {
-        "language": "Unknown",
-        "document_type": "Document",
-        "summary": text[:500] + "..." if len(text) > 500 else text,
-        "key_information": {
-            "important_details": ["Document processed with text analysis"],
-            "dates": [],
-            "amounts": [],
-            "names": [],
-            "actions_required": []
-        },
-        "extracted_data": {
-            "raw_analysis": text
-        },
-        "error": "JSON parsing failed, using text analysis"
-    }
+    if 'document_type' not in result:
+        result['document_type'] = 'Document'
+    if 'summary' not in result:
+        result['summary'] = 'Document analyzed successfully'
+    if 'key_information' not in result:
+        result['key_information'] = {}
+    if 'extracted_data' not in result:
+        result['extracted_data'] = {}
+    elif isinstance(result['extracted_data'], list):
+        # The response schema returns key/value pairs; expose them as a
+        # mapping, keeping the first value if the model repeats a key
+        extracted_data = {}
+        for item in result['extracted_data']:
+            if isinstance(item, dict):
+                extracted_data.setdefault(item.get('key', ''), item.get('value', ''))
+        result['extracted_data'] = extracted_data
+    return result
 
 def _get_fallback_response(error_message: str) -> dict:
     """
@@ -1,8 +1,13 @@
 # main.py
 
 import os
+import hashlib
 import tempfile
 import logging
+import ahocorasick
+from contextlib import asynccontextmanager
+import orjson
+from cachetools import LRUCache, TTLCache
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -14,7 +19,14 @@ from fastapi.middleware.cors import CORSMiddleware
 import textract_service
 import google_ai_service
 
-app = FastAPI(title="Document Analysis API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Releases shared resources (Google AI client and batching tasks, PDF worker pool) on shutdown."""
+    yield
+    await google_ai_service.aclose()
+    textract_service.shutdown_pdf_pool()
+
+app = FastAPI(title="Document Analysis API", lifespan=lifespan)
 logging.basicConfig(level=logging.INFO)
 
 # Configure CORS for development (restrict in production)
@@ -29,6 +41,13 @@ app.add_middleware(
 # Allowed file extensions
 ALLOWED_EXTENSIONS = [".pdf", ".docx", ".csv", ".xlsx", ".png", ".jpg", ".jpeg", ".txt"]
 
+# Uploads are copied to disk in chunks of this size to keep memory bounded
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Analyses of previously seen uploads, keyed on (content digest, extension, model).
+# Values are orjson-serialized so each hit returns a fresh copy.
+_analysis_cache = TTLCache(maxsize=1024, ttl=3600)
+
 def validate_file(file: UploadFile):
     """Validates the uploaded file extension."""
     ext = Path(file.filename).suffix.lower()
@@ -38,64 +57,83 @@ def validate_file(file: UploadFile):
             detail=f"Unsupported file type: {ext}. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
         )
 
-def infer_document_type_from_content(text: str) -> str:
-    """
-    Intelligently infers document type from content using keyword analysis.
-    """
-    text_lower = text.lower()
-    
+# Document type keywords in priority order: the first category with a
+# matching keyword wins, so earlier entries take precedence over later ones.
+DOCUMENT_TYPE_KEYWORDS = [
     # Financial documents
-    if any(word in text_lower for word in ['invoice', 'bill', 'payment', 'amount due', 'total']):
-        return "Invoice"
-    elif any(word in text_lower for word in ['balance sheet', 'assets', 'liabilities', 'equity']):
-        return "Balance Sheet"
-    elif any(word in text_lower for word in ['profit', 'loss', 'revenue', 'income statement']):
-        return "Profit & Loss Statement"
-    elif any(word in text_lower for word in ['receipt', 'purchase', 'transaction']):
-        return "Receipt"
-    
+    ("Invoice", ['invoice', 'bill', 'payment', 'amount due', 'total']),
+    ("Balance Sheet", ['balance sheet', 'assets', 'liabilities', 'equity']),
+    ("Profit & Loss Statement", ['profit', 'loss', 'revenue', 'income statement']),
+    ("Receipt", ['receipt', 'purchase', 'transaction']),
+
     # Legal documents
-    elif any(word in text_lower for word in ['contract', 'agreement', 'terms', 'clause', 'party']):
-        return "Contract"
-    elif any(word in text_lower for word in ['legal', 'attorney', 'lawyer', 'court']):
-        return "Legal Document"
-    
+    ("Contract", ['contract', 'agreement', 'terms', 'clause', 'party']),
+    ("Legal Document", ['legal', 'attorney', 'lawyer', 'court']),
+
     # Business documents
-    elif any(word in text_lower for word in ['report', 'analysis', 'findings', 'conclusion']):
-        return "Report"
-    elif any(word in text_lower for word in ['proposal', 'offer', 'quote', 'estimate']):
-        return "Proposal"
-    elif any(word in text_lower for word in ['memo', 'memorandum', 'internal']):
-        return "Memo"
-    elif any(word in text_lower for word in ['policy', 'procedure', 'guideline']):
-        return "Policy Document"
-    
+    ("Report", ['report', 'analysis', 'findings', 'conclusion']),
+    ("Proposal", ['proposal', 'offer', 'quote', 'estimate']),
+    ("Memo", ['memo', 'memorandum', 'internal']),
+    ("Policy Document", ['policy', 'procedure', 'guideline']),
+
     # Personal documents
-    elif any(word in text_lower for word in ['resume', 'cv', 'curriculum vitae', 'experience', 'skills']):
-        return "Resume"
-    elif any(word in text_lower for word in ['letter', 'dear', 'sincerely', 'yours truly']):
-        return "Letter"
-    elif any(word in text_lower for word in ['certificate', 'certification', 'award']):
-        return "Certificate"
-    
+    ("Resume", ['resume', 'cv', 'curriculum vitae', 'experience', 'skills']),
+    ("Letter", ['letter', 'dear', 'sincerely', 'yours truly']),
+    ("Certificate", ['certificate', 'certification', 'award']),
+
     # Technical documents
-    elif any(word in text_lower for word in ['manual', 'guide', 'instruction', 'how to']):
-        return "Manual"
-    elif any(word in text_lower for word in ['specification', 'technical', 'specs']):
-        return "Technical Document"
-    
+    ("Manual", ['manual', 'guide', 'instruction', 'how to']),
+    ("Technical Document", ['specification', 'technical', 'specs']),
+
     # Academic documents
-    elif any(word in text_lower for word in ['research', 'study', 'academic', 'university']):
-        return "Academic Document"
-    
+    ("Academic Document", ['research', 'study', 'academic', 'university']),
+
     # Government documents
-    elif any(word in text_lower for word in ['government', 'official', 'department', 'ministry']):
-        return "Government Document"
-    
+    ("Government Document", ['government', 'official', 'department', 'ministry']),
+
     # Medical documents
-    elif any(word in text_lower for word in ['medical', 'health', 'patient', 'diagnosis', 'treatment']):
-        return "Medical Document"
-    
+    ("Medical Document", ['medical', 'health', 'patient', 'diagnosis', 'treatment']),
+]
+
+# Build a single Aho-Corasick automaton so the text is scanned once instead
+# of once per keyword.
+_keyword_automaton = ahocorasick.Automaton()
+for _priority, (_category, _keywords) in enumerate(DOCUMENT_TYPE_KEYWORDS):
+    for _keyword in _keywords:
+        # Keep the highest-priority category if a keyword is listed twice
+        if _keyword not in _keyword_automaton:
+            _keyword_automaton.add_word(_keyword, (_priority, _category))
+_keyword_automaton.make_automaton()
+
+# Inferred document types keyed on a digest of the text, so repeated
+# documents skip the keyword scan
+_document_type_cache = LRUCache(maxsize=4096)
+
+def infer_document_type_from_content(text: str) -> str:
+    """
+    Intelligently infers document type from content using keyword analysis.
+    Results are memoized on a digest of the full text.
+    """
+    key = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    doc_type = _document_type_cache.get(key)
+    if doc_type is None:
+        doc_type = _classify_document_type(text)
+        _document_type_cache[key] = doc_type
+    return doc_type
+
+def _classify_document_type(text: str) -> str:
+    """Scans the text for document type keywords."""
+    text_lower = text.lower()
+
+    best = None
+    for _, (priority, category) in _keyword_automaton.iter(text_lower):
+        if best is None or priority < best[0]:
+            best = (priority, category)
+            if priority == 0:
+                break
+    if best is not None:
+        return best[1]
+
     # If no specific type is detected, return a descriptive type based on content length
     if len(text) < 100:
         return "Short Document"
@@ -115,18 +153,34 @@ async def analyze(file: UploadFile = File(...)):
     tmp_path = None
     try:
         validate_file(file)
+        ext = Path(file.filename).suffix.lower()
 
+        hasher = hashlib.blake2b(digest_size=16)
         with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp:
-            file_bytes = await file.read()
-            tmp.write(file_bytes)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                tmp.write(chunk)
             tmp_path = tmp.name
 
-        extracted_text = await textract_service.extract_text_from_upload(tmp_path, file_bytes)
+        # Identical uploads reuse the earlier analysis instead of calling Gemini again
+        cache_key = (hasher.hexdigest(), ext, google_ai_service.GOOGLE_MODEL)
+        cached = _analysis_cache.get(cache_key)
+        if cached is not None:
+            analysis_result = orjson.loads(cached)
+            doc_type = analysis_result["document_type"]
+            logging.info(f"Returning cached analysis for {file.filename}. Type: {doc_type}")
+            return {
+                "filename": file.filename,
+                "document_type": doc_type,
+                "analysis": analysis_result
+            }
+
+        extracted_text = await textract_service.extract_text_from_upload(tmp_path)
         if not extracted_text or not extracted_text.strip():
             raise HTTPException(status_code=422, detail="Failed to extract text from document.")
 
         # Analyze the document content
-        analysis_result = await google_ai_service.analyze_document(extracted_text)
+        analysis_result = await google_ai_service.analyze_document(extracted_text, kind=ext)
         
         # Ensure we have a valid result structure
         if not isinstance(analysis_result, dict):
@@ -145,6 +199,10 @@ async def analyze(file: UploadFile = File(...)):
             doc_type = infer_document_type_from_content(extracted_text)
             analysis_result["document_type"] = doc_type
 
+        # Fallback responses carry an "error" key; only cache real analyses
+        if "error" not in analysis_result:
+            _analysis_cache[cache_key] = orjson.dumps(analysis_result)
+
         logging.info(f"Analysis successful for {file.filename}. Type: {doc_type}")
 
         return {
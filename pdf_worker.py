@@ -0,0 +1,42 @@
+# pdf_worker.py
+
+# PDF text extraction that runs inside the PDF process pool. PDFium is not
+# thread-safe, so it is only ever called here, in single-task worker
+# processes. Spawned workers import only this module, so keep its imports
+# limited to pypdfium2.
+
+import pypdfium2 as pdfium
+
+def _pages_text(pdf, start, stop):
+    """Extracts text from pages [start, stop) of an open PDFium document."""
+    return "\n".join(pdf[index].get_textpage().get_text_range() for index in range(start, stop))
+
+def extract_pages(file_path, start, stop):
+    """Extracts text from pages [start, stop) of a digital PDF."""
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        return _pages_text(pdf, start, stop)
+    finally:
+        pdf.close()
+
+def extract_if_small(file_path, max_pages):
+    """
+    Returns (page_count, text) for a digital PDF. text is None when the PDF
+    has more than max_pages pages, so the caller can split it across workers.
+    """
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        page_count = len(pdf)
+        if page_count > max_pages:
+            return page_count, None
+        return page_count, _pages_text(pdf, 0, page_count)
+    finally:
+        pdf.close()
+
+def page_count(file_path):
+    """Returns the number of pages in a PDF."""
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
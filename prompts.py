@@ -24,10 +24,9 @@ Respond in this JSON format:
     "names": ["any", "important", "names", "or", "entities"],
     "actions_required": ["any", "required", "actions", "or", "deadlines"]
   },
-  "extracted_data": {
-    "key1": "value1",
-    "key2": "value2"
-  }
+  "extracted_data": [
+    {"key": "field name", "value": "field value"}
+  ]
 }
 
 Focus on providing practical, useful information that helps understand the document quickly. Be specific about what the document contains and any important details that stand out.
@@ -35,4 +34,100 @@ Focus on providing practical, useful information that helps understand the docum
 Document types can include: Invoice, Receipt, Contract, Report, Letter, Resume, Certificate, Manual, Policy, Statement, Notice, Memo, Proposal, Guide, Technical Document, Academic Document, Medical Document, Legal Document, Government Document, and any other specific type that fits the content.
 
 Always try to identify the most specific and accurate document type based on the content.
-"""
\ No newline at end of file
+"""
+
+# Shorter prompts specialized for inputs whose kind is known from the file
+# extension. The response schema already enforces the JSON shape, so these
+# only describe the fields and the relevant document types.
+
+TABLE_PROMPT = """
+You are an expert data analysis AI. The following text is a spreadsheet or table exported as CSV. Summarize what the data represents and extract its key information.
+
+Identify the language and document type, summarize the purpose and contents of the table (columns, what each row represents, notable totals, ranges or trends), and list important details, dates, amounts, names and required actions. Put notable figures and headline values in extracted_data.
+
+Respond in JSON with the fields language, document_type, summary, key_information and extracted_data.
+
+Document types can include: Balance Sheet, Profit & Loss Statement, Cash Flow Statement, Budget, Invoice, Expense Report, Inventory, Price List, Sales Report, Payroll, Schedule, Contact List, Data Export, and any other specific type that fits the content.
+"""
+
+OCR_PROMPT = """
+You are an expert document analysis AI. The following text was extracted by OCR from a photo or scan, so it may contain recognition errors, broken lines or stray characters. Interpret it sensibly and provide a summary with key information.
+
+Identify the language and document type, summarize the document's purpose and content, and list important details, dates, amounts, names and required actions. Put specific fields such as numbers, identifiers and totals in extracted_data.
+
+Respond in JSON with the fields language, document_type, summary, key_information and extracted_data.
+
+Document types can include: Receipt, Invoice, ID Document, Business Card, Letter, Form, Certificate, Ticket, Notice, Handwritten Note, and any other specific type that fits the content.
+"""
+
+# Prompt to use per file extension; anything else uses ANALYSIS_PROMPT
+PROMPT_BY_EXT = {
+    ".csv": TABLE_PROMPT,
+    ".xlsx": TABLE_PROMPT,
+    ".png": OCR_PROMPT,
+    ".jpg": OCR_PROMPT,
+    ".jpeg": OCR_PROMPT,
+}
+
+# Appended to the analysis prompt when several concurrent requests are
+# coalesced into one call. Each document follows a "=== Document N ===" header.
+BATCH_INSTRUCTIONS = """
+You will receive several independent documents, each introduced by a line of the form "=== Document N ===".
+
+Analyze each document separately and respond with a JSON array containing exactly one object per document, in the same order as the documents, where every object follows the JSON format above. Never merge information across documents.
+"""
+
+
+# Map step for documents too long to analyze in one call: each section is
+# condensed separately before the sections are analyzed together.
+PARTIAL_SUMMARY_PROMPT = """
+You are an expert document analysis AI. The text below is one section of a longer document.
+
+Write a dense plain-text summary of this section only. Preserve every important detail: dates, amounts, names, entities, identifiers, obligations, deadlines, actions required, and any clues about what type of document this is. Do not respond in JSON.
+"""
+
+# Reduce step: introduces the section summaries produced with PARTIAL_SUMMARY_PROMPT.
+MERGE_INSTRUCTIONS = """
+The document was too long to analyze in one pass. Below are summaries of its consecutive sections, in order. Analyze the document as a whole based on these summaries.
+"""
+
+
+# Response schemas passed to Gemini so it always returns valid JSON in the
+# shape described above. Gemini objects need declared properties, so the
+# free-form extracted_data fields are returned as key/value pairs whose
+# values may be strings, numbers or booleans.
+_STRING_LIST = {"type": "ARRAY", "items": {"type": "STRING"}}
+
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "language": {"type": "STRING"},
+        "document_type": {"type": "STRING"},
+        "summary": {"type": "STRING"},
+        "key_information": {
+            "type": "OBJECT",
+            "properties": {
+                "important_details": _STRING_LIST,
+                "dates": _STRING_LIST,
+                "amounts": _STRING_LIST,
+                "names": _STRING_LIST,
+                "actions_required": _STRING_LIST,
+            },
+            "required": ["important_details", "dates", "amounts", "names", "actions_required"],
+        },
+        "extracted_data": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "key": {"type": "STRING"},
+                    "value": {"anyOf": [{"type": "STRING"}, {"type": "NUMBER"}, {"type": "BOOLEAN"}]},
+                },
+                "required": ["key", "value"],
+            },
+        },
+    },
+    "required": ["language", "document_type", "summary", "key_information", "extracted_data"],
+}
+
+BATCH_ANALYSIS_SCHEMA = {"type": "ARRAY", "items": ANALYSIS_SCHEMA}
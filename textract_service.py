@@ -4,11 +4,19 @@ import os
 import logging
 import boto3
 import pdfplumber
+import zipfile
 import pandas as pd
-from docx import Document
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from lxml import etree
 from io import BytesIO
 from botocore.exceptions import ClientError
 import asyncio
+import threading
+import pdf_worker
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 # Initialize AWS Textract client conditionally
@@ -38,24 +46,166 @@ except Exception as e:
     textract_client = None
     aws_available = False
 
+# .txt files below this size are read inline; the thread hop would cost more
+# than the read itself. Every other format is parsed on the thread pool.
+SMALL_FILE_THRESHOLD = 256 * 1024
+
+# Opt-in: start Textract OCR for single-page PDFs alongside native extraction
+# so scanned PDFs don't wait for the native attempt first. Each such PDF then
+# costs one Textract call even when its text layer is usable. Multi-page PDFs
+# are never speculated on, as synchronous Textract only accepts one page.
+TEXTRACT_SPECULATIVE_OCR = os.getenv("TEXTRACT_SPECULATIVE_OCR", "false").lower() == "true"
+
+# All PDFium work runs in a process pool; PDFs with more pages than this are
+# also split across its workers
+PDF_PARALLEL_PAGE_THRESHOLD = 8
+
+def _default_pdf_workers():
+    """CPUs this process may run on, capped because every web worker gets its own pool."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is Linux-only
+        cpus = os.cpu_count() or 1
+    return min(cpus, 4)
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "0")) or _default_pdf_workers()
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool():
+    """Lazily creates the process pool shared by all PDF extractions."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # 'spawn' avoids forking a process that already runs threads
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pdf_pool
+
+def _discard_broken_pdf_pool(pool):
+    """
+    Drops a pool whose worker died (e.g. a PDFium crash or an OOM kill) so
+    the next PDF spawns a fresh one instead of failing with BrokenProcessPool.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            logging.warning("PDF worker process died; recreating the PDF process pool.")
+            pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = None
+
+def shutdown_pdf_pool():
+    """Stops the PDF worker processes. Called on application shutdown."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(cancel_futures=True)
+            _pdf_pool = None
+
 # --- Synchronous blocking functions ---
 # These functions perform the actual file processing and are designed
 # to be run in a separate thread to avoid blocking the server.
 
-def _extract_pdf_sync(file_path):
-    """Extracts text from a digital PDF."""
+def _extract_pdf_plumber_sync(file_path):
+    """Extracts text from a digital PDF with pdfplumber."""
     with pdfplumber.open(file_path) as pdf:
         return "".join(page.extract_text() or "" for page in pdf.pages)
 
+def _extract_pdf_sync(file_path):
+    """
+    Extracts text from a digital PDF using PDFium. Falls back to pdfplumber
+    if PDFium fails or finds no text.
+    """
+    try:
+        text = _extract_pdfium_sync(file_path)
+    except Exception as e:
+        logging.warning(f"PDFium extraction failed for {file_path}: {e}. Falling back to pdfplumber.")
+        text = ""
+
+    if text.strip():
+        return text
+    return _extract_pdf_plumber_sync(file_path)
+
+def _extract_pdfium_sync(file_path):
+    """
+    Extracts text from a digital PDF using PDFium, spreading large files
+    across processes. PDFium is not thread-safe, so it only runs in the
+    process pool.
+    """
+    pool = _get_pdf_pool()
+    try:
+        max_pages = PDF_PARALLEL_PAGE_THRESHOLD if PDF_WORKERS > 1 else float("inf")
+        page_count, text = pool.submit(pdf_worker.extract_if_small, file_path, max_pages).result()
+
+        if text is None:
+            # One contiguous page range per worker, reassembled in page order
+            step = -(-page_count // PDF_WORKERS)
+            futures = [
+                pool.submit(pdf_worker.extract_pages, file_path, start, min(start + step, page_count))
+                for start in range(0, page_count, step)
+            ]
+            text = "\n".join(future.result() for future in futures)
+    except BrokenProcessPool:
+        _discard_broken_pdf_pool(pool)
+        raise
+    return text
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DOCX_TEXT_TAGS = {_W + "t": None, _W + "tab": "\t", _W + "br": "\n", _W + "cr": "\n"}
+_OFFICE_DOCUMENT_REL = "/officeDocument"
+_PACKAGE_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+# Uploads are untrusted: never expand entities or fetch external resources
+_SAFE_XML = {"resolve_entities": False, "no_network": True}
+
+def _docx_main_part(archive):
+    """
+    Returns the archive path of the main document part, as declared by the
+    package relationships in _rels/.rels.
+    """
+    rels = etree.fromstring(archive.read("_rels/.rels"), etree.XMLParser(**_SAFE_XML))
+    for rel in rels.iter(_PACKAGE_REL):
+        if rel.get("Type", "").endswith(_OFFICE_DOCUMENT_REL) and rel.get("TargetMode") != "External":
+            return rel.get("Target").lstrip("/")
+    raise ValueError("DOCX package has no main document part")
+
 def _extract_docx_sync(file_path):
-    """Extracts text from a .docx file."""
-    doc = Document(file_path)
-    return "\n".join([para.text for para in doc.paragraphs])
+    """
+    Extracts text from a .docx file, one line per top-level paragraph.
+    The main document part is streamed with lxml and each paragraph or table
+    is discarded once processed, so the whole tree is never held in memory.
+    """
+    lines = []
+    with zipfile.ZipFile(file_path) as archive, archive.open(_docx_main_part(archive)) as xml:
+        for _, elem in etree.iterparse(xml, events=("end",), tag=(_W + "p", _W + "tbl"), **_SAFE_XML):
+            parent = elem.getparent()
+            if parent is None or parent.tag != _W + "body":
+                continue
+            if elem.tag == _W + "p":
+                lines.append("".join(
+                    (node.text or "") if _DOCX_TEXT_TAGS[node.tag] is None else _DOCX_TEXT_TAGS[node.tag]
+                    for node in elem.iter(*_DOCX_TEXT_TAGS)
+                ))
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+    return "\n".join(lines)
 
 def _extract_table_sync(file_path, is_csv):
-    """Extracts text from a .csv or .xlsx file."""
-    df = pd.read_csv(file_path) if is_csv else pd.read_excel(file_path)
-    return df.to_string(index=False)
+    """Extracts text from a .csv or .xlsx file as CSV text."""
+    if is_csv:
+        try:
+            table = pa_csv.read_csv(file_path)
+        except pa.ArrowInvalid:
+            # Ragged or otherwise irregular CSVs are left to pandas' tolerant parser
+            return pd.read_csv(file_path).to_csv(index=False)
+        buf = BytesIO()
+        pa_csv.write_csv(table, buf)
+        return buf.getvalue().decode('utf-8', 'ignore')
+    return pd.read_excel(file_path, engine="calamine").to_csv(index=False)
 
 def _extract_txt_sync(file_path):
     """Extracts text from a plain .txt file."""
@@ -63,8 +213,15 @@ def _extract_txt_sync(file_path):
     with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
         return f.read()
 
-def _textract_sync(file_bytes):
+def _textract_sync(file_path):
     """Performs OCR using AWS Textract for images or scanned documents."""
+    # Only load the file into memory once OCR is actually needed
+    with open(file_path, 'rb') as f:
+        file_bytes = f.read()
+    return _textract_bytes_sync(file_bytes)
+
+def _textract_bytes_sync(file_bytes):
+    """Performs OCR using AWS Textract on in-memory file contents."""
     if not aws_available or textract_client is None:
         raise Exception("AWS Textract is not available. Please configure AWS credentials.")
     response = textract_client.detect_document_text(Document={"Bytes": file_bytes})
@@ -73,18 +230,70 @@ def _textract_sync(file_bytes):
 # --- Main async function ---
 # This is the single entry point called by your main application.
 
-async def extract_text_from_upload(file_path: str, file_bytes: bytes) -> str:
+async def extract_text_from_upload(file_path: str) -> str:
     """
     Extracts text from various file types. It tries native libraries first
     for efficiency and falls back to AWS Textract for images and scanned documents.
-    All blocking I/O is run in a separate thread.
+    With TEXTRACT_SPECULATIVE_OCR, Textract is started for single-page PDFs
+    alongside the native attempt and discarded if the native text is usable.
+    Blocking I/O is run in a separate thread, except for small .txt files
+    which are cheaper to read inline.
     """
     ext = Path(file_path).suffix.lower()
+
+    textract_task = None
+    if ext == ".pdf" and aws_available and TEXTRACT_SPECULATIVE_OCR:
+        textract_task = await _start_speculative_textract(file_path)
+
+    try:
+        return await _extract_text(file_path, ext, textract_task)
+    finally:
+        if textract_task is not None and not textract_task.done():
+            textract_task.cancel()
+
+async def _start_speculative_textract(file_path):
+    """
+    Starts Textract on a single-page PDF in the background. The bytes are read
+    (off the event loop) before the task starts, so the Textract thread never
+    touches the temp file, which the caller may delete while an abandoned
+    Textract call is still in flight.
+    Returns None for multi-page or unreadable PDFs.
+    """
+    pool = _get_pdf_pool()
+    try:
+        pages = await asyncio.wrap_future(pool.submit(pdf_worker.page_count, file_path))
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            _discard_broken_pdf_pool(pool)
+        logging.warning(f"Could not count pages of {file_path}; skipping speculative Textract: {e}")
+        return None
+    if pages != 1:
+        return None
+    file_bytes = await asyncio.to_thread(Path(file_path).read_bytes)
+    task = asyncio.create_task(asyncio.to_thread(_textract_bytes_sync, file_bytes))
+    task.add_done_callback(_consume_task_result)
+    return task
+
+def _consume_task_result(task):
+    """Marks a discarded task's exception as retrieved."""
+    if not task.cancelled():
+        task.exception()
+
+async def _textract(file_path, textract_task):
+    """Returns the speculative Textract result, or runs Textract now."""
+    if textract_task is not None:
+        return await textract_task
+    return await asyncio.to_thread(_textract_sync, file_path)
+
+async def _extract_text(file_path, ext, textract_task):
+    """Native extraction with Textract fallback for extract_text_from_upload."""
     full_text = ""
 
     try:
         # Step 1: Attempt extraction with efficient, native libraries
-        if ext == ".pdf":
+        if ext == ".txt" and os.stat(file_path).st_size < SMALL_FILE_THRESHOLD:
+            full_text = _extract_txt_sync(file_path)
+        elif ext == ".pdf":
             full_text = await asyncio.to_thread(_extract_pdf_sync, file_path)
         elif ext == ".docx":
             full_text = await asyncio.to_thread(_extract_docx_sync, file_path)
@@ -101,7 +310,7 @@ async def extract_text_from_upload(file_path: str, file_bytes: bytes) -> str:
         # Step 2: Fallback to AWS Textract for images, scanned PDFs, or failed extractions
         if aws_available:
             logging.info(f"Falling back to AWS Textract for {file_path}")
-            return await asyncio.to_thread(_textract_sync, file_bytes)
+            return await _textract(file_path, textract_task)
         else:
             logging.warning(f"AWS Textract not available. Cannot process {file_path} as image/OCR document.")
             return ""
@@ -111,7 +320,7 @@ async def extract_text_from_upload(file_path: str, file_bytes: bytes) -> str:
         logging.error(f"Error during text extraction for {file_path}: {e}. Attempting Textract as final fallback.", exc_info=True)
         try:
             if aws_available:
-                return await asyncio.to_thread(_textract_sync, file_bytes)
+                return await _textract(file_path, textract_task)
             else:
                 logging.warning("AWS Textract not available for fallback processing.")
                 return ""